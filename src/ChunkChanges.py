@@ -1,22 +1,209 @@
 # STL resources
 import hashlib
+import json
+import os
+import os.path
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from threading import Lock
 
 # ECBU modules
 from UploadAbstraction import ECBUMediaUpload
 
+# Directory where digests and chunk listings are persisted between runs
+CACHE_DIRECTORY: str = os.path.join(os.path.expanduser('~'), '.cache', 'ecbu')
+
+# Chunks at or below this size (32 MiB) are hashed with a single read and
+# a single md5 call; larger chunks are streamed to bound memory use.
+SINGLE_READ_HASH_LIMIT: int = 32 * (1024 * 1024)
+# Read size for the streaming path; 1 MiB amortizes the Python-level
+# loop overhead per read.
+STREAMING_HASH_READ_SIZE: int = 1 * (1024 * 1024)
+
+# Digests already computed this run, keyed by ECBUMediaUpload.identity().
+# Retries and cache refreshes re-hash the same unchanged bytes otherwise.
+_digest_memo: dict = dict()
+
+
+# Files whose persisted digests were already pulled into the memo
+_loaded_digest_files: set = set()
+
+
+def _digest_cache_file_name(path: str) -> str:
+    """
+    The sidecar file where digests for the file at path are persisted
+    between runs.
+    """
+    return os.path.join(CACHE_DIRECTORY, '{}.digests.json'.format(
+        hashlib.sha1(path.encode()).hexdigest()))
+
+
+def _load_persisted_digests(path: str):
+    """
+    Pull the digests remembered for this file by previous runs into the
+    memo, once per path. Entries are keyed by the mtime recorded when
+    they were computed, so digests of since-modified files simply never
+    match a current identity and cost nothing beyond the load.
+    """
+    if not path or path in _loaded_digest_files:
+        return
+    _loaded_digest_files.add(path)
+    cache_file_name: str = _digest_cache_file_name(path)
+    if not os.path.exists(cache_file_name):
+        return
+    with open(cache_file_name, 'r') as cache_file:
+        saved: dict = json.load(cache_file)
+    mtime_ns: int = saved.get('mtime_ns')
+    for indices, digest in saved.get('digests', {}).items():
+        begin_index, _, end_index = indices.partition(':')
+        _digest_memo.setdefault(
+            (path, mtime_ns, int(begin_index), int(end_index)), digest)
+
+
+def _persist_digests(path: str, mtime_ns: int):
+    """
+    Save every digest known for this version of the file so the next
+    run can skip rehashing unchanged chunks entirely.
+    """
+    os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+    digests: dict = {
+        '{}:{}'.format(begin_index, end_index): digest
+        for (digest_path, digest_mtime, begin_index, end_index), digest
+        in _digest_memo.items()
+        if digest_path == path and digest_mtime == mtime_ns}
+    with open(_digest_cache_file_name(path), 'w') as cache_file:
+        json.dump({'mtime_ns': mtime_ns, 'digests': digests}, cache_file)
+
+
+def _new_md5(data: bytes = b''):
+    """
+    OpenSSL-backed md5 context, flagged as a non-security use so that
+    hardened (FIPS) builds still hand back their fastest EVP
+    implementation instead of refusing to construct one.
+    """
+    return hashlib.md5(data, usedforsecurity=False)
+
+
+class _ChunkDigestReader:
+    """
+    Minimal file-like wrapper over an ECBUMediaUpload so that
+    hashlib.file_digest can drive the reads through readinto; the
+    passed lock (if any) is held across each read since the underlying
+    file descriptor may be shared between threads.
+    """
+
+    def __init__(self, file_chunk: ECBUMediaUpload, read_lock=None):
+        self._file_chunk = file_chunk
+        self._read_lock = read_lock if read_lock is not None \
+            else nullcontext()
+        self._offset = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        with self._read_lock:
+            bytes_read: int = self._file_chunk.readinto(
+                buffer, self._offset)
+        self._offset += bytes_read
+        return bytes_read
+
 
 def hash_ecbu_media_file_upload(file_chunk: ECBUMediaUpload) -> str:
     """
     md5 hash the contents of the passed file_chunk, and return
-    it as a hexstring
+    it as a hexstring. Digests are memoized by the chunk's on-disk
+    identity so repeat calls for the same unchanged bytes are free.
+    """
+    return _hash_with_memo(file_chunk)
+
+
+def _hash_with_memo(file_chunk: ECBUMediaUpload, read_lock=None) -> str:
     """
-    hasher = hashlib.md5()
-    # Append each chunk of the file to the hasher
+    Return the memoized digest for this chunk if there is one,
+    otherwise hash its contents and remember the result.
+    """
+    # Check whether this exact chunk has already been hashed, this run
+    # or a previous one
+    identity: tuple = file_chunk.identity()
+    if identity is not None:
+        _load_persisted_digests(identity[0])
+    memoized_digest: str = _digest_memo.get(identity)
+    if memoized_digest is not None:
+        return memoized_digest
+    digest: str = _hash_chunk_contents(file_chunk, read_lock)
+    if identity is not None:
+        _digest_memo[identity] = digest
+    return digest
+
+
+def _hash_chunk_contents(file_chunk: ECBUMediaUpload,
+                         read_lock=None) -> str:
+    """
+    md5 hash the bytes of the passed file_chunk without consulting
+    the digest memo, holding read_lock (when given) across reads of
+    the shared file descriptor.
+    """
+    # Hash straight out of the page cache when the chunk can be memory
+    # mapped: no descriptor seeks, no read syscalls, no copies, and no
+    # need for the read lock.
+    buffer = file_chunk.getbuffer()
+    if buffer is not None:
+        return _new_md5(buffer).hexdigest()
+    read_lock = read_lock if read_lock is not None else nullcontext()
+    # Small enough to hash with one read and one C-level md5 call
+    if file_chunk.size() <= SINGLE_READ_HASH_LIMIT:
+        with read_lock:
+            contents: bytes = file_chunk.getbytes(0, file_chunk.size())
+        return _new_md5(contents).hexdigest()
+    # Let file_digest (python 3.11+) drive the streaming loop in C,
+    # reading into its reusable buffer instead of allocating per read
+    if hasattr(hashlib, 'file_digest'):
+        return hashlib.file_digest(
+            _ChunkDigestReader(file_chunk, read_lock), _new_md5).hexdigest()
+    hasher = _new_md5()
+    # Append each chunk of the file to the hasher, reading into one
+    # reusable buffer instead of allocating a bytes object per read
+    buffer = memoryview(bytearray(STREAMING_HASH_READ_SIZE))
     bytes_hashed: int = 0
-    while bytes_hashed < file_chunk.size():
-        current_chunk: bytes = file_chunk.getbytes(
-            bytes_hashed, file_chunk.chunksize())
-        bytes_hashed += len(current_chunk)
-        hasher.update(current_chunk)
+    size: int = file_chunk.size()
+    while bytes_hashed < size:
+        with read_lock:
+            bytes_read: int = file_chunk.readinto(buffer, bytes_hashed)
+        if bytes_read == 0:
+            break
+        hasher.update(buffer[:bytes_read])
+        bytes_hashed += bytes_read
     # Turn it into a hex_digest and return
     return hasher.hexdigest()
+
+
+def hash_ecbu_media_file_uploads(named_file_chunks: list) -> dict:
+    """
+    md5 hash each (file_chunk_name, file_chunk) pair in named_file_chunks
+    across a pool of worker threads, and return a dictionary mapping each
+    file_chunk_name to its hexstring digest.
+
+    The chunks all wrap the same underlying file descriptor, so reads are
+    serialized with a lock; hashlib releases the GIL while digesting each
+    buffer, so the md5 work itself still runs across cores.
+    """
+    read_lock: Lock = Lock()
+    # Submit each chunk to the pool, then collect the digests by name.
+    # Keep at least 8 hash lanes in flight so that hashing can proceed
+    # while other workers are blocked on the read lock.
+    # os.cpu_count() can return None when the count is undeterminable
+    with ThreadPoolExecutor(max_workers=max(os.cpu_count() or 1, 8)) as pool:
+        futures: dict = {
+            file_chunk_name: pool.submit(_hash_with_memo, file_chunk,
+                                         read_lock)
+            for file_chunk_name, file_chunk in named_file_chunks}
+        digests: dict = {file_chunk_name: future.result()
+                         for file_chunk_name, future in futures.items()}
+    # Remember the digests for this version of the file, so the next
+    # run of an unchanged file skips hashing altogether
+    if named_file_chunks:
+        identity: tuple = named_file_chunks[0][1].identity()
+        if identity is not None:
+            _persist_digests(identity[0], identity[1])
+    return digests
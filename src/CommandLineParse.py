@@ -1,18 +1,21 @@
-def parse_integer_argument(int_arg: str, error_str: str) -> int or None:
+# STL resources
+from argparse import ArgumentTypeError
+
+
+def integer_argument(int_arg: str) -> int:
     """
-    Parse a user entered integer argument as an integer from a string.
-    If an error occurs, inform the user.
+    argparse type= validator for the chunk-size style integer
+    arguments: parse the user's string and bounds-check it once at
+    parse time, letting argparse report the problem, instead of every
+    caller re-validating after the fact.
     """
-    resultant_int: int = None
-    if int_arg:
-        try:
-            resultant_int = int(int_arg)
-            # Make sure the argument isn't out of sensible bounds
-            if resultant_int > 1000 or resultant_int < 0:
-                print("Chunk arguments should be in 0 < chunk_argument <= 1000")
-                return None
-        # Passed argument wasn't a string
-        except ValueError:
-            print(error_str)
-            return None
+    # Gate on a digit check instead of paying for the exception
+    # machinery on invalid input
+    if not int_arg.lstrip('-').isdigit():
+        raise ArgumentTypeError("'{}' is not an integer.".format(int_arg))
+    resultant_int: int = int(int_arg)
+    # Make sure the argument isn't out of sensible bounds
+    if not 0 < resultant_int <= 1000:
+        raise ArgumentTypeError(
+            "Chunk arguments should be in 0 < chunk_argument <= 1000")
     return resultant_int
@@ -1,14 +1,36 @@
 # STL resources
+import fcntl
+import json
 import os.path
-import pickle
 
 # Google API libraries
+import httplib2
 from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 
 SCOPES = ["https://www.googleapis.com/auth/drive.file"]
 
+# Saved credentials live here as flat JSON; cheaper to parse than a
+# pickle and can't execute anything on load.
+TOKEN_FILE = 'token.json'
+
+
+def _save_credentials(credentials):
+    """
+    Write the credentials out as JSON, holding an exclusive lock so
+    concurrently running ECBU instances don't interleave writes.
+    """
+    # Append mode leaves the existing contents alone until the lock is
+    # ours; opening with 'w' would empty the file first and let a
+    # concurrent reader lock an already-truncated token
+    with open(TOKEN_FILE, 'a') as token:
+        fcntl.flock(token, fcntl.LOCK_EX)
+        token.truncate(0)
+        token.write(credentials.to_json())
+
 
 def _get_credentials() -> object:
     """
@@ -16,9 +38,16 @@ def _get_credentials() -> object:
     """
     credentials = None
     # Check if we have saved credentials
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
-            credentials = pickle.load(token)
+    if os.path.exists(TOKEN_FILE):
+        with open(TOKEN_FILE, 'r') as token:
+            fcntl.flock(token, fcntl.LOCK_SH)
+            try:
+                credentials = Credentials.from_authorized_user_info(
+                    json.load(token), SCOPES)
+            # An empty or half-written token file just means the OAuth
+            # flow below has to run again
+            except ValueError:
+                credentials = None
     # Request credentials
     if not credentials or not credentials.valid:
         # Credentials require refreshing
@@ -29,9 +58,8 @@ def _get_credentials() -> object:
             flow = InstalledAppFlow.from_client_secrets_file(
                 'credentials.json', SCOPES)
             credentials = flow.run_local_server(port=0)
-            # Save the credentials to the token file
-            with open('token.pickle', 'wb') as token:
-                pickle.dump(credentials, token)
+        # Save the credentials to the token file
+        _save_credentials(credentials)
     return credentials
 
 
@@ -44,4 +72,11 @@ def get_drive_service() -> object or None:
     if credentials is None:
         print("Error. unable to acquire credentials.")
         return None
-    return build('drive', 'v3', credentials=credentials)
+    # Build the service over one explicit keep-alive transport:
+    # httplib2 holds the TCP+TLS connection to googleapis open between
+    # requests made through the same Http object, so consecutive chunk
+    # uploads don't each pay a fresh handshake. static_discovery uses
+    # the drive discovery document bundled with the client library,
+    # saving the https fetch of it on every startup.
+    return build('drive', 'v3', static_discovery=True,
+                 http=AuthorizedHttp(credentials, http=httplib2.Http()))
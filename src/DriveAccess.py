@@ -1,16 +1,76 @@
 # STL resources
-import re
+import json
+import os
+import os.path
+import pickle
 import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+# Google API libraries
+from googleapiclient.errors import HttpError
 
 # ECBU modules
-from ChunkChanges import hash_ecbu_media_file_upload
+from ChunkChanges import CACHE_DIRECTORY, hash_ecbu_media_file_upload
+from ErrorWaiting import IncreasingBackoff, RequestRateLimiter
 from UploadAbstraction import ECBUMediaUpload
 
+# Shared limiter keeping metadata requests comfortably under the google
+# drive quota of 1000 requests per 100 seconds per user
+_list_rate_limiter: RequestRateLimiter = RequestRateLimiter(10)
+
+# Workers that speculatively hash a local chunk while a (network-bound)
+# cache refresh is still in flight; md5 releases the GIL so the two
+# genuinely overlap.
+_speculative_hash_pool: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=4)
+
+# Keep batched queries under drive's limit on query text length
+QUERY_TEXT_LIMIT: int = 7 * 1024
+
+# Drive accepts at most this many calls per batch http request
+BATCH_REQUEST_LIMIT: int = 100
+
+
+def _execute_with_backoff(request):
+    """
+    Execute a drive metadata request, backing off and retrying when
+    drive signals that we are being rate limited instead of failing
+    the whole backup.
+    """
+    backoff: IncreasingBackoff = IncreasingBackoff(0.5, 10 * (60), 2)
+    while True:
+        try:
+            return request.execute()
+        except HttpError as e:
+            status: int = e.resp.status
+            rate_limited: bool = status == 429 or \
+                (status == 403 and 'ratelimitexceeded' in str(e).lower())
+            if not rate_limited:
+                raise
+            # Honor drive's Retry-After header when it gives one,
+            # otherwise fall back to our own increasing backoff
+            retry_after: str = e.resp.get('retry-after')
+            if retry_after is not None and retry_after.isdigit():
+                print("Rate limited by drive. Waiting: {} seconds."
+                      .format(retry_after))
+                time.sleep(int(retry_after))
+            else:
+                print("Rate limited by drive. Waiting: {} seconds."
+                      .format(backoff.wait_time))
+                backoff.wait()
+
+
+def _escape_query_value(value: str) -> str:
+    """
+    Escape a string for embedding in single quotes in a drive query.
+    """
+    return value.replace("\\", "\\\\").replace("'", "\\'")
+
 
 class ChangedFile:
     """
-    Simple struct returned by check_if_chunk_exists to detect chunk changes
-    (Which need to be uploaded and which don't)
+    Simple struct returned by check_if_chunk_exists_or_changed to detect
+    chunk changes (Which need to be uploaded and which don't)
     """
 
     def __init__(self, changed: bool, file_id: str):
@@ -29,7 +89,35 @@ class DriveChunks(object):
     def __init__(self, service: object, folder_id: str):
         self._service = service
         self.folder_id = folder_id
+        # The listing query never changes for a folder; build it once
+        self._list_query = "'{}' in parents and trashed = false".format(
+            folder_id)
         self._chunk_changes_cache = None
+        self._chunks_by_name = None
+        # Whether a listing has been loaded at all; checked instead of
+        # the cache's truthiness, since a first backup into an empty
+        # folder legitimately loads an empty listing
+        self._cache_loaded = False
+        # Chunks indexed by their md5, for content-addressed dedup
+        self._chunks_by_md5 = dict()
+        self._local_digests = dict()
+        self._persisted_modified_time = None
+        # The folder's modifiedTime is fetched at most once per run
+        self._known_modified_time = None
+        # Whether the cache only covers the chunks of one backup pass
+        # (from prime_existence) rather than the whole folder
+        self._cache_is_partial = False
+        # Serializes cache updates from parallel chunk uploads
+        self._record_lock = Lock()
+
+    def set_local_digests(self, local_digests: dict):
+        """
+        Store a dictionary mapping chunk names to md5 hexstrings of the
+        local copies of those chunks, computed ahead of time (e.g. across
+        worker threads) so that check_if_chunk_exists_or_changed doesn't
+        need to hash each chunk on demand.
+        """
+        self._local_digests = local_digests
 
     @staticmethod
     def _chunk_name_to_num(chunk_name: str) -> int:
@@ -38,7 +126,7 @@ class DriveChunks(object):
         including the '.', then convert it to an integer.
         i.e. isolate the 23 in HHS.23
         """
-        return int(re.sub(r'^(.*)\.', '', chunk_name))
+        return int(chunk_name.rpartition('.')[2])
 
     @staticmethod
     def _chunk_id_response_compare(item: dict) -> int:
@@ -48,38 +136,356 @@ class DriveChunks(object):
         """
         return DriveChunks._chunk_name_to_num(item.get('name'))
 
-    def _refresh_cache(self):
+    def _order_chunk_cache(self):
+        """
+        Order the cache by chunk number with an O(N) scatter into a
+        dense array; falls back to a comparison sort when the numbering
+        is irregular (gaps, duplicates, or unexpected names).
+        """
+        entries: list = self._chunk_changes_cache
+        slots: list = [None] * len(entries)
+        for entry in entries:
+            index: int = self._chunk_name_to_num(entry.get('name')) - 1
+            if index < 0 or index >= len(slots) or \
+                    slots[index] is not None:
+                entries.sort(key=self._chunk_id_response_compare)
+                return
+            slots[index] = entry
+        self._chunk_changes_cache = slots
+
+    def _index_chunks(self):
+        """
+        (Re)build the by-name and by-md5 indices over the chunk cache,
+        for O(1) lookups during change detection and dedup.
+        """
+        self._chunks_by_name = {
+            chunk.get('name'): chunk for chunk in self._chunk_changes_cache}
+        self._chunks_by_md5 = {
+            chunk.get('md5Checksum'): chunk
+            for chunk in self._chunk_changes_cache
+            if chunk.get('md5Checksum') and chunk.get('id')}
+
+    def _cache_file_name(self) -> str:
+        """
+        The file name used to persist this folder's chunk listing
+        between runs.
+        """
+        return os.path.join(CACHE_DIRECTORY,
+                            '{}.pickle'.format(self.folder_id))
+
+    def _folder_modified_time(self) -> str:
+        """
+        Query google drive for when the backup folder was last modified.
+        Fetched once per run; every later caller re-uses the answer.
+        """
+        if self._known_modified_time is None:
+            response = _execute_with_backoff(self._service.files().get(
+                fileId=self.folder_id, fields='modifiedTime'))
+            self._known_modified_time = response.get('modifiedTime')
+        return self._known_modified_time
+
+    def _manifest_file_name(self) -> str:
+        """
+        The file name used to persist the manifest of the last completed
+        backup into this folder.
+        """
+        return os.path.join(CACHE_DIRECTORY,
+                            '{}.manifest.json'.format(self.folder_id))
+
+    def backup_is_current(self, file_size: int, file_mtime_ns: int) -> bool:
         """
-        Refresh local list of chunks stored up in google drive
+        Check whether the local file is byte-for-byte the one already
+        backed up into this folder, using the manifest saved when the
+        last backup completed. When the local (size, mtime) and the
+        folder's modifiedTime all match the manifest, the whole run can
+        stop here: one metadata request instead of a per-chunk walk.
         """
+        manifest_file_name: str = self._manifest_file_name()
+        if not os.path.exists(manifest_file_name):
+            return False
+        with open(manifest_file_name, 'r') as manifest_file:
+            manifest: dict = json.load(manifest_file)
+        # The local file has been modified since the last backup
+        if manifest.get('size') != file_size or \
+                manifest.get('mtime_ns') != file_mtime_ns:
+            return False
+        # Make sure the folder hasn't been touched by someone else
+        # (another machine, or the user) since the manifest was saved
+        return manifest.get('modified_time') == self._folder_modified_time()
+
+    def store_backup_manifest(self, file_size: int, file_mtime_ns: int):
+        """
+        Remember the (size, mtime) of the file that was just backed up,
+        so the next run of an unchanged file can fast-fail without
+        walking any chunks.
+        """
+        os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+        with open(self._manifest_file_name(), 'w') as manifest_file:
+            json.dump({'size': file_size, 'mtime_ns': file_mtime_ns,
+                       'modified_time': self._folder_modified_time()},
+                      manifest_file)
+
+    def _load_persisted_cache(self, folder_modified_time: str,
+                              accept_partial: bool = False) -> bool:
+        """
+        Try to load the chunk listing persisted by a previous run.
+        Returns True when a listing was found and the folder hasn't been
+        modified since it was saved, False otherwise. Listings that only
+        cover one backup pass's chunks are skipped unless the caller can
+        work with a partial view.
+        """
+        cache_file_name: str = self._cache_file_name()
+        if not os.path.exists(cache_file_name):
+            return False
+        with open(cache_file_name, 'rb') as cache_file:
+            persisted: dict = pickle.load(cache_file)
+        # The folder has been modified since this listing was saved
+        if persisted.get('modified_time') != folder_modified_time:
+            return False
+        # The saved listing doesn't cover the whole folder
+        if persisted.get('partial') and not accept_partial:
+            return False
+        self._chunk_changes_cache = persisted.get('chunks')
+        self._index_chunks()
+        self._persisted_modified_time = folder_modified_time
+        self._cache_is_partial = bool(persisted.get('partial'))
+        self._cache_loaded = True
+        return True
+
+    def _persist_cache(self):
+        """
+        Save the current chunk listing to disk so the next run can skip
+        re-enumerating the folder if it hasn't been modified.
+        """
+        os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+        with open(self._cache_file_name(), 'wb') as cache_file:
+            pickle.dump({'modified_time': self._persisted_modified_time,
+                         'partial': self._cache_is_partial,
+                         'chunks': self._chunk_changes_cache}, cache_file)
+
+    def record_chunk_upload(self, file_chunk_name: str, file_id: str,
+                            chunk_size: int = None):
+        """
+        Update the cached listing after a chunk was uploaded so that the
+        cache (and its persisted copy) stays in step with what is now up
+        in google drive; otherwise the next run could try to re-create a
+        chunk that already exists.
+        """
+        with self._record_lock:
+            chunk: dict = self._chunks_by_name.get(file_chunk_name)
+            # The chunk was created rather than updated
+            if chunk is None:
+                chunk = {'name': file_chunk_name}
+                self._chunk_changes_cache.append(chunk)
+                self._order_chunk_cache()
+                self._chunks_by_name[file_chunk_name] = chunk
+            if file_id is not None:
+                chunk['id'] = file_id
+            if chunk_size is not None:
+                chunk['size'] = str(chunk_size)
+            # The uploaded bytes were the local ones, so the remote
+            # checksum now matches the local digest.
+            local_hash: str = self._local_digests.get(file_chunk_name)
+            if local_hash is not None:
+                chunk['md5Checksum'] = local_hash
+                # This chunk is now a dedup source for its bytes
+                if chunk.get('id'):
+                    self._chunks_by_md5.setdefault(local_hash, chunk)
+            self._persist_cache()
+
+    def deduplicate_chunk(self, file_chunk_name: str,
+                          service: object = None) -> str or None:
+        """
+        If some other chunk already in drive holds exactly the bytes of
+        the named local chunk (by md5), copy it server-side into this
+        folder under file_chunk_name and return the new file id; the
+        caller can then skip uploading the bytes entirely. Returns None
+        when no identical chunk is known, or the local digest isn't.
+
+        Callers on worker threads must pass their own per-worker
+        service, since the shared one sits on a single http connection
+        that isn't safe to use from several threads at once.
+
+        Purely opportunistic: a partial (primed) cache only knows the
+        chunks of this backup pass, so hits across the rest of the
+        folder need a run that did a full listing at some point.
+        """
+        if service is None:
+            service = self._service
+        local_hash: str = self._local_digests.get(file_chunk_name)
+        if local_hash is None:
+            return None
+        duplicate: dict = self._chunks_by_md5.get(local_hash)
+        if duplicate is None:
+            return None
+        response = _execute_with_backoff(service.files().copy(
+            fileId=duplicate.get('id'),
+            body={'name': file_chunk_name, 'parents': [self.folder_id]},
+            fields='id'))
+        return response.get('id')
+
+    def batch_deduplicate_chunks(self, named_chunk_sizes: list):
+        """
+        Dedup pre-pass over a whole backup: for every (file_chunk_name,
+        chunk_size) pair naming a chunk that isn't in drive yet but
+        whose bytes already are (by md5), issue the server-side copies
+        together through drive's batch endpoint, up to 100 calls per
+        http round trip instead of one round trip per copy. Recorded
+        copies then show up as up to date to the per-chunk checks.
+        """
+        copyable: list = [
+            (file_chunk_name, chunk_size)
+            for file_chunk_name, chunk_size in named_chunk_sizes
+            if self._chunks_by_name.get(file_chunk_name) is None and
+            self._local_digests.get(file_chunk_name) in self._chunks_by_md5]
+        if not copyable:
+            return
+
+        def record_copy(request_id, response, exception):
+            # A failed copy just stays an ordinary upload later
+            if exception is not None:
+                return
+            file_chunk_name, chunk_size = pending[request_id]
+            self.record_chunk_upload(file_chunk_name, response.get('id'),
+                                     chunk_size)
+
+        # Send the copies in batches of up to 100 calls each
+        for batch_start in range(0, len(copyable), BATCH_REQUEST_LIMIT):
+            batch = self._service.new_batch_http_request(
+                callback=record_copy)
+            pending: dict = dict()
+            for file_chunk_name, chunk_size in \
+                    copyable[batch_start:batch_start + BATCH_REQUEST_LIMIT]:
+                duplicate: dict = self._chunks_by_md5.get(
+                    self._local_digests.get(file_chunk_name))
+                pending[file_chunk_name] = (file_chunk_name, chunk_size)
+                batch.add(self._service.files().copy(
+                    fileId=duplicate.get('id'),
+                    body={'name': file_chunk_name,
+                          'parents': [self.folder_id]},
+                    fields='id'), request_id=file_chunk_name)
+            _list_rate_limiter.wait_for_turn()
+            _execute_with_backoff(batch)
+
+    def prime_existence(self, file_chunk_names: list):
+        """
+        Populate the cache with just the named chunks using batched
+        name-filtered queries, instead of enumerating the whole folder.
+        Cheaper than a full refresh when the folder holds many more
+        chunks than this backup pass will touch. The resulting cache is
+        marked partial so restore never mistakes it for a full listing.
+        """
+        folder_modified_time: str = self._folder_modified_time()
+        # A full or previously-primed listing for this folder works too
+        if self._cache_loaded or \
+                self._load_persisted_cache(folder_modified_time,
+                                           accept_partial=True):
+            return
         self._chunk_changes_cache = list()
+        # Batch the names into as few queries as the query text
+        # length limit allows
+        base_query: str = "'{}' in parents and trashed = false and ({})" \
+            .format(self.folder_id, '{}')
+        name_terms: list = ["name = '{}'".format(_escape_query_value(name))
+                            for name in file_chunk_names]
+        batch: list = list()
+        batch_length: int = 0
+        for term in name_terms:
+            if batch and \
+                    (batch_length + len(term)) > QUERY_TEXT_LIMIT:
+                self._list_named_chunks(base_query.format(' or '.join(batch)))
+                batch = list()
+                batch_length = 0
+            batch.append(term)
+            batch_length += len(term) + len(' or ')
+        if batch:
+            self._list_named_chunks(base_query.format(' or '.join(batch)))
+        # Order and index what came back, and save it for the next run
+        self._order_chunk_cache()
+        self._index_chunks()
+        self._persisted_modified_time = folder_modified_time
+        self._cache_is_partial = True
+        self._cache_loaded = True
+        self._persist_cache()
+
+    def _list_named_chunks(self, query: str):
+        """
+        Run one name-filtered listing query and append the results to
+        the cache.
+        """
         page_token = None
         while True:
-            response = self._service.files().list(q="'{}' in parents and trashed = false".format(self.folder_id),
-                                                  spaces='drive',
-                                                  fields='nextPageToken, files(id, name, size, md5Checksum)',
-                                                  pageToken=page_token).execute()
-            # Append the chunk information.
+            _list_rate_limiter.wait_for_turn()
+            response = _execute_with_backoff(self._service.files().list(
+                q=query, spaces='drive',
+                fields='nextPageToken, files(id, name, size, md5Checksum)',
+                pageSize=1000, pageToken=page_token))
             self._chunk_changes_cache += response.get('files', [])
-            # Move on to the next page
             page_token = response.get('nextPageToken', None)
-            # No more pages to look through
             if page_token is None:
                 break
-            # Sleep for 90ms to make sure our request does not exceed the google drive
-            # limit of 1000 requests per 100 seconds per user
-            time.sleep(0.09)
-        # Sort the chunk_information so that we restore the folder in the correct order
-        self._chunk_changes_cache.sort(key=self._chunk_id_response_compare)
+
+    def _refresh_cache(self, allow_persisted: bool = True,
+                       accept_partial: bool = False):
+        """
+        Refresh local list of chunks stored up in google drive,
+        re-using the listing persisted by a previous run when the folder
+        hasn't been modified since it was saved.
+        """
+        folder_modified_time: str = self._folder_modified_time()
+        # Replacing the cache races record_chunk_upload on parallel
+        # upload workers (a record landing in the old listing would be
+        # lost, then persisted away), so the swap happens under the same
+        # lock; whichever worker gets here first does the load and the
+        # rest find it already done when they acquire the lock
+        with self._record_lock:
+            if allow_persisted and self._cache_loaded and \
+                    (accept_partial or not self._cache_is_partial):
+                return
+            if allow_persisted and \
+                    self._load_persisted_cache(folder_modified_time,
+                                               accept_partial):
+                return
+            chunk_listing: list = list()
+            page_token = None
+            while True:
+                # Stay under the google drive limit of 1000 requests per 100
+                # seconds per user, without idling when pages come back slowly
+                _list_rate_limiter.wait_for_turn()
+                response = _execute_with_backoff(
+                    self._service.files().list(q=self._list_query,
+                                               spaces='drive',
+                                               fields='nextPageToken, files(id, name, size, md5Checksum)',
+                                               pageSize=1000,
+                                               pageToken=page_token))
+                # Append the chunk information.
+                chunk_listing += response.get('files', [])
+                # Move on to the next page
+                page_token = response.get('nextPageToken', None)
+                # No more pages to look through
+                if page_token is None:
+                    break
+            self._chunk_changes_cache = chunk_listing
+            # Order the chunk_information so that we restore the folder in the correct order
+            self._order_chunk_cache()
+            # Index the chunks by name for O(1) lookups during change detection
+            self._index_chunks()
+            # Save the fresh listing for the next run
+            self._persisted_modified_time = folder_modified_time
+            self._cache_is_partial = False
+            self._cache_loaded = True
+            self._persist_cache()
 
     def get_chunk_file_information(self, refresh_cache: bool = False) -> list:
         """
         Query google drive if cache isn't adequate and acquire the ids in order of each
-        chunk making up the file to restore.
+        chunk making up the file to restore. A partial (primed) cache is
+        never good enough here; restore needs the full listing.
         """
-        if not self._chunk_changes_cache or refresh_cache:
+        if not self._cache_loaded or refresh_cache or \
+                self._cache_is_partial:
             # Query the results from google drive
-            self._refresh_cache()
+            self._refresh_cache(allow_persisted=not refresh_cache)
         return self._chunk_changes_cache
 
     def check_if_chunk_exists_or_changed(self, file_chunk: ECBUMediaUpload,
@@ -98,32 +504,50 @@ class DriveChunks(object):
         If the file doesn't exist at all within the backup folder, return a True change, and a
         None id
         """
-        if not self._chunk_changes_cache or refresh_cache:
-            # Query the results from google drive
-            self._refresh_cache()
-        # Get the index for where we should find the chunk in the cache
-        chunk_idx: int = (self._chunk_name_to_num(file_chunk_name)) - 1
-        # Make sure the chunk_idx isn't out of bounds
-        if chunk_idx > (len(self._chunk_changes_cache) - 1):
-            # The file was not found
+        hash_future = None
+        if not self._cache_loaded or refresh_cache:
+            # Start hashing the local chunk in the background while the
+            # refresh waits on the network, unless its digest was
+            # already computed ahead of time.
+            if self._local_digests.get(file_chunk_name) is None:
+                hash_future = _speculative_hash_pool.submit(
+                    hash_ecbu_media_file_upload, file_chunk)
+            # Query the results from google drive; a primed partial
+            # listing is fine for a single-chunk existence check
+            self._refresh_cache(allow_persisted=not refresh_cache,
+                                accept_partial=True)
+        # Look the chunk up by name in the cache
+        chunk: dict = self._chunks_by_name.get(file_chunk_name)
+        if chunk is None:
+            # The file was not found. Don't leave the speculative hash
+            # reading the descriptor behind the caller's back.
+            if hash_future is not None:
+                hash_future.result()
             return ChangedFile(True, None)
-        # Get the chunk
-        chunk: object = self._chunk_changes_cache[chunk_idx]
-        # Verify the name is correct
-        if file_chunk_name == chunk.get('name'):
-            file_id: str = chunk.get('id')
-            md5hash: str = chunk.get('md5Checksum')
-            local_hash: str = hash_ecbu_media_file_upload(
-                file_chunk)
-            # Check whether this chunk has changed since last time
-            # it was uploaded by comparing the hashes.
-            if md5hash == local_hash:
-                return ChangedFile(False, None)
-            # Otherwise the chunk has been changed, and needs to be
-            # re-uploaded.
+        file_id: str = chunk.get('id')
+        md5hash: str = chunk.get('md5Checksum')
+        # A size mismatch means the chunk has definitely changed;
+        # don't bother hashing it
+        remote_size: str = chunk.get('size')
+        if remote_size is not None and int(remote_size) != file_chunk.size():
+            if hash_future is not None:
+                hash_future.result()
             return ChangedFile(True, file_id)
-        # The file was not found
-        return ChangedFile(True, None)
+        # Use the digest computed ahead of time or speculatively above
+        # if there is one, otherwise hash the local copy now.
+        local_hash: str = self._local_digests.get(file_chunk_name)
+        if local_hash is None:
+            if hash_future is not None:
+                local_hash = hash_future.result()
+            else:
+                local_hash = hash_ecbu_media_file_upload(file_chunk)
+        # Check whether this chunk has changed since last time
+        # it was uploaded by comparing the hashes.
+        if md5hash == local_hash:
+            return ChangedFile(False, None)
+        # Otherwise the chunk has been changed, and needs to be
+        # re-uploaded.
+        return ChangedFile(True, file_id)
 
 
 def find_or_create_backup_folder(service, dest_folder_name: str,
@@ -134,19 +558,22 @@ def find_or_create_backup_folder(service, dest_folder_name: str,
     """
     folder_id = None
     page_token = None
+    # Have drive filter on the folder name server-side, rather than
+    # paging every folder this application can see back to the client
+    escaped_name: str = dest_folder_name.replace(
+        "\\", "\\\\").replace("'", "\\'")
+    query: str = "mimeType = 'application/vnd.google-apps.folder' and " \
+        "trashed = false and name = '{}'".format(escaped_name)
     while True:
-        response = service.files().list(q="mimeType = 'application/vnd.google-apps.folder' and trashed = false",
-                                        spaces='drive', fields='nextPageToken, files(id, name)',
-                                        pageToken=page_token).execute()
-        # Look through each of the files accessable to this application, and see if there is already a folder
-        # there for backing up this file.
+        # Stay under the drive request quota across pages
+        _list_rate_limiter.wait_for_turn()
+        response = _execute_with_backoff(
+            service.files().list(q=query, spaces='drive',
+                                 fields='nextPageToken, files(id)',
+                                 pageSize=1000, pageToken=page_token))
+        # Any result is a folder with the requested name
         for file in response.get('files', []):
-            folder_name: str = file.get('name')
-            file_id: str = file.get('id')
-            # Found a folder to upload this file to
-            # already.
-            if folder_name == dest_folder_name:
-                folder_id = file_id
+            folder_id = file.get('id')
         # Move on to the next page
         page_token = response.get('nextPageToken', None)
         # No more pages to look through
@@ -154,9 +581,9 @@ def find_or_create_backup_folder(service, dest_folder_name: str,
             break
     # Folder doesn't exist, we need to create one
     if folder_id is None and create_mode:
-        result = service.files().create(body={
+        result = _execute_with_backoff(service.files().create(body={
             'name': dest_folder_name,
             'mimeType': 'application/vnd.google-apps.folder'
-        }, fields='id').execute()
+        }, fields='id'))
         folder_id = result.get('id')
     return folder_id
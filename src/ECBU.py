@@ -1,22 +1,51 @@
 # STL resources
-import math
+import logging
 import os.path
+import random
+import threading
 import time
 from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor
 
 # Google API libraries
 from googleapiclient.errors import HttpError
 
 # ECBU modules
-from CommandLineParse import parse_integer_argument
+from ChunkChanges import hash_ecbu_media_file_uploads
+from CommandLineParse import integer_argument
 from Credentials import get_drive_service
 from DriveAccess import ChangedFile, DriveChunks, find_or_create_backup_folder
 from ErrorWaiting import IncreasingBackoff
 from UploadAbstraction import ECBUMediaUpload
 
+# Resumable upload pieces are grown geometrically up to this cap while
+# the link keeps finishing them quickly, so fast links aren't starved
+# by a small fixed piece size
+MAX_TUNED_UPLOAD_CHUNK: int = 32 * (1024 * 1024)
+# A piece finishing faster than this many seconds means the link has
+# headroom for a bigger one
+UPLOAD_CHUNK_GROWTH_TARGET: float = 2.0
+
+# Largest piece size the link has proven it can handle quickly; shared
+# across chunks so later ones start at the tuned size right away
+_tuned_upload_chunk_size: int = 0
+
+# Progress messages go through the logging machinery rather than bare
+# print calls, so each one isn't a separate line-buffered write syscall
+# serialized on the GIL in the middle of the upload loop
+logger: logging.Logger = logging.getLogger('ecbu')
+# Only log upload progress every this many percent
+PROGRESS_LOG_STEP: int = 5
+
+# How many times to re-attempt a chunk whose upload failed in a
+# non-resumable way before giving up on the backup; a chunk that fails
+# this many times with backoff in between isn't a transient problem
+MAX_CHUNK_UPLOAD_ATTEMPTS: int = 10
+
 
 def backup_chunked_file_piece(service: object, drive_chunks: DriveChunks, file_chunk: ECBUMediaUpload,
-                              file_chunk_name: str, chunk_num: int, num_chunks: int) -> bool:
+                              file_chunk_name: str, chunk_num: int, num_chunks: int,
+                              file_status: ChangedFile = None) -> bool:
     """
     Using the check_if_chunk_exists function, check whether this file_chunk has already been backed up before
     If it has, but the hashes don't match becuase the local copy has been modified, update the file in google
@@ -27,126 +56,389 @@ def backup_chunked_file_piece(service: object, drive_chunks: DriveChunks, file_c
     or hours :/, then the upload can resume; requiring not have to re-upload the pieces of the chunk; this
     hopefully can save precious bandwidth.
     """
-    print("Beginning upload of chunk: {}, Chunk: {} Out of: {}.".format(
-        file_chunk_name, chunk_num, num_chunks))
-    # Check whether this chunk has been uploaded before
-    file_status: ChangedFile = drive_chunks.check_if_chunk_exists_or_changed(
-        file_chunk, file_chunk_name)
+    # Check whether this chunk has been uploaded before, unless the
+    # caller already checked (e.g. overlapped with the previous upload)
+    if file_status is None:
+        file_status = drive_chunks.check_if_chunk_exists_or_changed(
+            file_chunk, file_chunk_name)
+    # The chunk has not changed and does not need to be re-uploaded;
+    # this is the steady-state case on re-runs, so get it out of the
+    # way before any other work
+    if not file_status.changed:
+        logger.info("Chunk: %s is already up to date!", file_chunk_name)
+        return True
+    logger.info("Beginning upload of chunk: %s, Chunk: %s Out of: %s.",
+                file_chunk_name, chunk_num, num_chunks)
     # Upload the file_chunk to google drive
-    request = None
     # Chunk has never been uploaded before
-    if file_status.changed and not file_status.file_id:
-        request = service.files().create(
-            media_body=file_chunk, body={'name': file_chunk_name, 'parents': [drive_chunks.folder_id]})
+    if not file_status.file_id:
+        # If drive already holds these exact bytes under another chunk,
+        # have it copy them server-side instead of uploading them again;
+        # the copy goes through this call's service so parallel workers
+        # use their own connection rather than the shared one
+        duplicate_id: str = drive_chunks.deduplicate_chunk(
+            file_chunk_name, service)
+        if duplicate_id is not None:
+            drive_chunks.record_chunk_upload(
+                file_chunk_name, duplicate_id, file_chunk.size())
+            logger.info("Chunk: %s deduplicated from identical bytes already "
+                        "in drive.", file_chunk_name)
+            return True
+        def build_request():
+            return service.files().create(
+                media_body=file_chunk,
+                body={'name': file_chunk_name, 'parents': [drive_chunks.folder_id]})
+        request = build_request()
     # Chunk has been uploaded before but it has been changed
-    elif file_status.changed and file_status.file_id:
-        request = service.files().update(
-            media_body=file_chunk, fileId=file_status.file_id)
-    # The chunk has not changed and does not need to be re-uploaded.
     else:
-        print("Chunk: {} is already up to date!".format(file_chunk_name))
-        return True
+        def build_request():
+            return service.files().update(
+                media_body=file_chunk, fileId=file_status.file_id)
+        request = build_request()
+    # Start at the piece size the link has already proven out, if that
+    # is bigger than what this chunk was built with
+    global _tuned_upload_chunk_size
+    if _tuned_upload_chunk_size > file_chunk.chunksize():
+        file_chunk.set_chunksize(_tuned_upload_chunk_size)
     # beginning back-off duration for if an error occurs and we try to resume
     backoff: IncreasingBackoff = IncreasingBackoff(0.5, 10 * (60), 2)
     response = None
+    # Percentage at which progress was last logged; starting below zero
+    # so the first report always goes out
+    last_logged_progress: int = -PROGRESS_LOG_STEP
     while response is None:
         # Attempt to upload a chunk of the file
         try:
+            piece_started: float = time.monotonic()
             status, response = request.next_chunk()
+            piece_elapsed: float = time.monotonic() - piece_started
         # Catch any errors that occur, attempting to continue
         # uploading if possible
         except HttpError as e:
-            if e.resp.status in [500, 502, 503, 504]:
-                # Call next chunk again, using increasing backoff
-                print("An error occurred. Trying again with increasing backoff."
-                      " Waiting: {} seconds.".format(backoff.wait_time))
+            if e.resp.status in [429, 500, 502, 503, 504]:
+                # Being rate limited isn't fatal either; prefer the
+                # wait drive asked for over our own backoff, with a
+                # little jitter so parallel workers don't all come
+                # back at the same instant
+                retry_after: str = e.resp.get('retry-after')
+                if retry_after is not None and retry_after.isdigit():
+                    wait_hint: int = int(retry_after)
+                    logger.info("Rate limited while uploading chunk."
+                                " Waiting: %s seconds.", wait_hint)
+                    time.sleep(wait_hint + random.uniform(0, wait_hint * 0.1))
+                else:
+                    # Call next chunk again, using increasing backoff
+                    logger.info("An error occurred. Trying again with increasing backoff."
+                                " Waiting: %s seconds.", backoff.wait_time)
+                    backoff.wait()
+                response = None
+                continue
+            elif e.resp.status == 404:
+                # The resumable session expired (drive keeps them for
+                # about a week) or was otherwise dropped; open a fresh
+                # session for this chunk rather than failing it out to
+                # the outer retry loop and re-checking against drive
+                logger.info("Resumable session for chunk: %s was lost."
+                            " Starting a new session in %s seconds.",
+                            file_chunk_name, backoff.wait_time)
                 backoff.wait()
+                request = build_request()
                 response = None
                 continue
             else:
                 # Error and quit
-                print("Fatal Error {} while uploading chunk.".format(e.resp.status))
+                logger.error("Fatal Error %s while uploading chunk.",
+                             e.resp.status)
                 return False
         # Handle the internet connection going out while backing up the file
         except Exception:
-            print('Connection timed out, attempting again in {} seconds.'.format(
-                backoff.wait_time))
+            logger.info('Connection timed out, attempting again in %s seconds.',
+                        backoff.wait_time)
             backoff.wait()
             continue
         # Reset increasing backoff time amount
         backoff.reset_to_initial()
+        # The piece went through quickly; grow the next one so the
+        # per-piece round trip stops dominating on fast links
+        if piece_elapsed < UPLOAD_CHUNK_GROWTH_TARGET and \
+                file_chunk.chunksize() < MAX_TUNED_UPLOAD_CHUNK:
+            file_chunk.set_chunksize(
+                min(file_chunk.chunksize() * 2, MAX_TUNED_UPLOAD_CHUNK))
+            _tuned_upload_chunk_size = max(
+                _tuned_upload_chunk_size, file_chunk.chunksize())
         if status:
-            print("Chunk upload progress: {}%.".format(
-                int(status.progress() * 100)))
-    print("Upload of Chunk: {} Complete!".format(file_chunk_name))
+            # Throttle progress reporting; one message per resumable
+            # piece is pure syscall overhead on fast links
+            progress: int = int(status.progress() * 100)
+            if (progress - last_logged_progress) >= PROGRESS_LOG_STEP:
+                logger.info("Chunk upload progress: %s%%.", progress)
+                last_logged_progress = progress
+            else:
+                logger.debug("Chunk upload progress: %s%%.", progress)
+    # Keep the cached listing in step with the chunk that is now in drive
+    drive_chunks.record_chunk_upload(file_chunk_name, response.get('id'),
+                                     file_chunk.size())
+    logger.info("Upload of Chunk: %s Complete!", file_chunk_name)
     return True
 
 
-def begin_backup(service, local_file_name: str, dest_folder_name: str,
-                 file_chunk_size: int = 250, upload_chunk_size: int = 1) -> bool:
-    """
-    service: google drive service
-    local_file_name: name of the file on disk
-    dest_folder_name: the name of the folder for this to be stored in on
-        google drive
-    file_chunk_size: the size in MB for each of the chunks in the uploaded
-        folder to be.
-    upload_chunk_size: the size in MiB of the resumable upload chunks for
-        uploading the file chunk to google drive.
-    """
-    # Get or create the parent folder for our chunked backup file
-    folder_id: str = find_or_create_backup_folder(service, dest_folder_name)
-    # Create the DriveChunks Object
-    drive_chunks: DriveChunks = DriveChunks(service, folder_id)
-    # Unable to find or make a folder to back up the file to
-    if folder_id is None:
-        return False
+def _drop_chunk_page_cache(fileno: int, begin_index: int, end_index: int):
+    """
+    Tell the kernel the just-uploaded chunk's pages won't be read
+    again, so a multi-gigabyte backup streams through a small slice of
+    the page cache instead of evicting everything else on the machine.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fileno, begin_index, end_index - begin_index,
+                             os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+
+
+def continuous_chunk_ul_retry(service, drive_chunks: DriveChunks,
+                              file_chunk: ECBUMediaUpload,
+                              file_chunk_name: str, chunk_num: int,
+                              num_chunks: int,
+                              file_status: ChangedFile = None) -> bool:
+    """
+    Keep attempting to upload the passed chunk until it succeeds or the
+    attempt limit is reached, waiting with increasing backoff between
+    failed attempts. Returns whether the chunk made it up to drive.
+    """
+    # Initialize the IncreasingBackoff retry object, incase something goes wrong
+    backoff: IncreasingBackoff = IncreasingBackoff(0.5, 10 * (60), 2)
+    # Upload this chunk to google drive, retrying a bounded number of
+    # times; a chunk that keeps failing fast (bad auth, gone folder)
+    # shouldn't spin here forever
+    for _ in range(MAX_CHUNK_UPLOAD_ATTEMPTS):
+        # Attempt to upload the chunk
+        if backup_chunked_file_piece(
+                service, drive_chunks, file_chunk, file_chunk_name,
+                chunk_num, num_chunks, file_status):
+            return True
+        # A pre-computed status is only good for the first attempt;
+        # re-check against drive on any retry
+        file_status = None
+        logger.info("Upload of this chunk failed in a non-resumable way. Re-attempting the upload "
+                    "in %s seconds.", backoff.wait_time)
+        backoff.wait()
+    logger.error("Giving up on chunk: %s after %s failed attempts.",
+                 file_chunk_name, MAX_CHUNK_UPLOAD_ATTEMPTS)
+    return False
+
+
+def _upload_chunks_in_parallel(local_file_name: str,
+                               drive_chunks: DriveChunks,
+                               chunk_boundaries: list, file_size: int,
+                               upload_chunk_size: int,
+                               parallel_chunks: int) -> bool:
+    """
+    Upload the chunks described by chunk_boundaries across a bounded
+    pool of worker threads. Each worker opens its own descriptor on the
+    local file and builds its own drive service, because neither the
+    shared file offset nor googleapiclient's service object is safe to
+    share between threads.
+    """
+    num_chunks: int = len(chunk_boundaries)
+    worker_state = threading.local()
+
+    def upload_one(chunk_num: int, file_chunk_name: str,
+                   begin_index: int, end_index: int) -> bool:
+        # Build (or re-use) this worker's own drive service
+        service = getattr(worker_state, 'service', None)
+        if service is None:
+            service = worker_state.service = get_drive_service()
+        # Read through a descriptor owned by this worker alone
+        with open(local_file_name, 'rb') as worker_file:
+            file_chunk = ECBUMediaUpload(
+                worker_file, file_size, begin_index, end_index,
+                chunk_size=(upload_chunk_size * (1024 * 1024)))
+            uploaded: bool = continuous_chunk_ul_retry(
+                service, drive_chunks, file_chunk, file_chunk_name,
+                chunk_num, num_chunks)
+            # This chunk's bytes are done with; release their pages
+            if uploaded:
+                _drop_chunk_page_cache(worker_file.fileno(),
+                                       begin_index, end_index)
+            return uploaded
+
+    with ThreadPoolExecutor(max_workers=parallel_chunks) as pool:
+        futures: list = [
+            pool.submit(upload_one, chunk_num, file_chunk_name,
+                        begin_index, end_index)
+            for chunk_num, (file_chunk_name, begin_index, end_index) in
+            enumerate(chunk_boundaries, 1)]
+        return all(future.result() for future in futures)
+
+
+class BackupSession(object):
+    """
+    Holds a drive service and the DriveChunks object for each backup
+    folder touched so far, so that backing up many files (or the same
+    file repeatedly, when used as a library) resolves each folder and
+    builds its chunk cache only once.
+    """
+
+    def __init__(self, service: object):
+        self._service = service
+        # DriveChunks per destination folder name
+        self._drive_chunks_by_folder: dict = dict()
+
+    def _folder_chunks(self, dest_folder_name: str) -> DriveChunks or None:
+        """
+        The DriveChunks object for the named backup folder, resolving
+        (or creating) the folder on first use and re-using it after.
+        """
+        drive_chunks: DriveChunks = self._drive_chunks_by_folder.get(
+            dest_folder_name)
+        if drive_chunks is None:
+            # Get or create the parent folder for our chunked backup file
+            folder_id: str = find_or_create_backup_folder(
+                self._service, dest_folder_name)
+            # Unable to find or make a folder to back up the file to
+            if folder_id is None:
+                return None
+            drive_chunks = DriveChunks(self._service, folder_id)
+            self._drive_chunks_by_folder[dest_folder_name] = drive_chunks
+        return drive_chunks
+
+    def backup(self, local_file_name: str, dest_folder_name: str,
+               file_chunk_size: int = 250, upload_chunk_size: int = 8,
+               parallel_chunks: int = 1) -> bool:
+        """
+        local_file_name: name of the file on disk
+        dest_folder_name: the name of the folder for this to be stored in on
+            google drive
+        file_chunk_size: the size in MB for each of the chunks in the uploaded
+            folder to be.
+        upload_chunk_size: the size in MiB of the resumable upload chunks for
+            uploading the file chunk to google drive.
+        parallel_chunks: how many chunks to upload at the same time.
+        """
+        service = self._service
+        drive_chunks: DriveChunks = self._folder_chunks(dest_folder_name)
+        if drive_chunks is None:
+            return False
+        return _chunk_and_upload(service, drive_chunks, local_file_name,
+                                 dest_folder_name, file_chunk_size,
+                                 upload_chunk_size, parallel_chunks)
+
+
+def _chunk_and_upload(service, drive_chunks: DriveChunks,
+                      local_file_name: str, dest_folder_name: str,
+                      file_chunk_size: int, upload_chunk_size: int,
+                      parallel_chunks: int) -> bool:
+    """
+    Chunk the local file and bring the backup folder up to date with it;
+    the folder resolution and cache live in the caller's BackupSession.
+    """
     # Open up the file and start chunking
     with open(local_file_name, 'rb') as local_file:
-        # Calculate the size of the file to backup
-        local_file.seek(0, os.SEEK_END)
-        file_size: int = local_file.tell()
-        # Calculate the number of file_chunk_size chunks to separate and upload
+        # One fstat gives both the size and the mtime of the file to
+        # back up, without moving the file position the way
+        # seek(0, SEEK_END) would
+        file_stats: os.stat_result = os.fstat(local_file.fileno())
+        file_size: int = file_stats.st_size
+        file_mtime_ns: int = file_stats.st_mtime_ns
+        # Let the kernel know the file is about to be read front to
+        # back, so its read-ahead stays armed for the chunking passes
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(local_file.fileno(), 0, file_size,
+                             os.POSIX_FADV_SEQUENTIAL)
+        # If the file hasn't been touched since the last completed
+        # backup into this folder, there is nothing to do at all
+        if drive_chunks.backup_is_current(file_size, file_mtime_ns):
+            logger.info("Backup of: %s as %s is already up to date.",
+                        local_file_name, dest_folder_name)
+            return True
+        # Compute the boundaries of each of the separated files up front
+        # as pure data: every chunk starts on a file_chunk_size stride
+        # and the last one is clamped to the end of the file, so the
+        # loop carries no accumulator and no out-of-bounds branch
         file_chunk_size *= (1000 * 1000)
-        num_chunk_files: int = math.ceil(file_size / file_chunk_size)
-        # Create a Media upload for each of the separated files and upload each of them
-        bytes_uploaded: int = 0
-        for chunk_num in range(1, num_chunk_files + 1):
-            # Find the end index for the current file chunk
-            end_index: int = bytes_uploaded + file_chunk_size
-            # If this is the last chunk, and it goes out of bounds,
-            # shorten it so that it doesn't
-            if end_index >= file_size:
-                end_index = file_size
-            # Create the ECBUMediaUpload object to represent this chunk of the file
-            file_chunk = ECBUMediaUpload(
-                local_file, file_size, bytes_uploaded, end_index,
-                chunk_size=(upload_chunk_size * (1024 * 1024)))
-            # Initialize the IncreasingBackoff retry object, incase something goes wrong
-            backoff: IncreasingBackoff = IncreasingBackoff(0.5, 10 * (60), 2)
-            # Upload this chunk to google drive
-            status: bool = False
-            while status is False:
-                # Attempt to upload the chunk
-                status = backup_chunked_file_piece(
-                    service, drive_chunks, file_chunk, dest_folder_name +
-                    '.' + str(chunk_num), chunk_num, num_chunk_files)
-                # If successful continue, otherwise wait and try again.
-                if status:
-                    backoff.reset_to_initial()
-                    break
-                print("Upload of this chunk failed in a non-resumable way. Re-attempting the upload "
-                      "in {} seconds.".format(backoff.wait_time))
-                backoff.wait()
-            # record the number of bytes uploaded
-            # and move the index over one to not re-upload the end index of the
-            # previous chunk as the start index of the next.
-            bytes_uploaded += file_chunk.size()
-        print("Upload of: {} as {} was successful.".format(
-            local_file_name, dest_folder_name))
+        chunk_boundaries: list = [
+            (dest_folder_name + '.' + str(chunk_num), begin_index,
+             min(begin_index + file_chunk_size, file_size))
+            for chunk_num, begin_index in enumerate(
+                range(0, file_size, file_chunk_size), 1)]
+        num_chunk_files: int = len(chunk_boundaries)
+        # Create a Media upload to represent each chunk of the file
+        named_file_chunks: list = [
+            (file_chunk_name, ECBUMediaUpload(
+                local_file, file_size, begin_index, end_index,
+                chunk_size=(upload_chunk_size * (1024 * 1024))))
+            for file_chunk_name, begin_index, end_index in chunk_boundaries]
+        # Hash every chunk across worker threads before uploading, so that
+        # change detection doesn't have to hash each chunk one at a time.
+        drive_chunks.set_local_digests(
+            hash_ecbu_media_file_uploads(named_file_chunks))
+        # Ask drive about just the chunks this backup will touch, rather
+        # than enumerating everything in the folder
+        drive_chunks.prime_existence(
+            [file_chunk_name for file_chunk_name, _, _ in chunk_boundaries])
+        # Create every dedup-able new chunk up front with batched
+        # server-side copies, so the upload loop below skips them
+        drive_chunks.batch_deduplicate_chunks(
+            [(file_chunk_name, end_index - begin_index)
+             for file_chunk_name, begin_index, end_index in chunk_boundaries])
+        # Upload the chunks across worker threads when asked to
+        if parallel_chunks > 1:
+            if not _upload_chunks_in_parallel(
+                    local_file_name, drive_chunks, chunk_boundaries,
+                    file_size, upload_chunk_size, parallel_chunks):
+                return False
+        # Otherwise upload each of the chunks to google drive in turn,
+        # overlapping the next chunk's change check (hash + metadata
+        # lookup) with the current chunk's network upload
+        else:
+            with ThreadPoolExecutor(max_workers=1) as prefetch_pool:
+                status_future = prefetch_pool.submit(
+                    drive_chunks.check_if_chunk_exists_or_changed,
+                    named_file_chunks[0][1], named_file_chunks[0][0]) \
+                    if named_file_chunks else None
+                for chunk_num, (file_chunk_name, file_chunk) in \
+                        enumerate(named_file_chunks, 1):
+                    # Pick up this chunk's prefetched status, then start
+                    # the next chunk's check before uploading
+                    file_status: ChangedFile = status_future.result()
+                    if chunk_num < num_chunk_files:
+                        next_name, next_chunk = named_file_chunks[chunk_num]
+                        status_future = prefetch_pool.submit(
+                            drive_chunks.check_if_chunk_exists_or_changed,
+                            next_chunk, next_name)
+                    if not continuous_chunk_ul_retry(
+                            service, drive_chunks, file_chunk,
+                            file_chunk_name, chunk_num, num_chunk_files,
+                            file_status):
+                        return False
+                    # This chunk's bytes are done with; release their
+                    # pages so the backup doesn't flush the page cache
+                    _, begin_index, end_index = \
+                        chunk_boundaries[chunk_num - 1]
+                    _drop_chunk_page_cache(local_file.fileno(),
+                                           begin_index, end_index)
+        # Every chunk is up in drive; remember this version of the file
+        # so the next run of it can stop after a single metadata request
+        drive_chunks.store_backup_manifest(file_size, file_mtime_ns)
+        logger.info("Upload of: %s as %s was successful.",
+                    local_file_name, dest_folder_name)
         return True
 
 
+def begin_backup(service, local_file_name: str, dest_folder_name: str,
+                 file_chunk_size: int = 250, upload_chunk_size: int = 8,
+                 parallel_chunks: int = 1) -> bool:
+    """
+    One-shot wrapper around BackupSession for the CLI (and existing
+    callers); use a BackupSession directly to back up several files
+    without re-resolving folders each time.
+    """
+    return BackupSession(service).backup(
+        local_file_name, dest_folder_name, file_chunk_size,
+        upload_chunk_size, parallel_chunks)
+
+
 def main():
     """
     Grab the CLI arguments passed by the user, and then begin a backup
@@ -164,11 +456,22 @@ def main():
                           help="Folder name in google drive to contain the "
                           "chunks of the backed-up file.")
     arg_parser.add_argument('--google-drive-chunk-size', dest="google_drive_chunk_size",
+                            type=integer_argument,
                             help="Size of each file chunk split up in the backup folder. (Megabytes)")
     arg_parser.add_argument('--file-upload-chunk-size', dest="file_upload_chunk_size",
-                            help="Chunk size for resumable uploads to the drive service. (MebiBytes)")
+                            type=integer_argument,
+                            help="Starting chunk size for resumable uploads to "
+                            "the drive service. (MebiBytes, default 8; smaller "
+                            "values lose less progress when the connection "
+                            "drops, larger ones spend fewer round trips)")
+    arg_parser.add_argument('--parallel-chunks', dest="parallel_chunks",
+                            type=integer_argument,
+                            help="How many chunks to upload to google "
+                            "drive at the same time.")
     # Parse the arguments entered by the user
     parsed_args: Namespace = arg_parser.parse_args()
+    # Send progress messages through logging rather than raw prints
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
     # Make sure all the required arguments are there
     if parsed_args.file_to_backup is None or \
        parsed_args.dest_folder_name is None:
@@ -176,50 +479,18 @@ def main():
         return
     # Create the drive service
     service = get_drive_service()
+    # Collect whichever optional arguments were passed into keyword
+    # arguments for begin_backup; argparse has already validated and
+    # converted them through the integer_argument type
+    backup_kwargs: dict = {
+        keyword: value for keyword, value in [
+            ('file_chunk_size', parsed_args.google_drive_chunk_size),
+            ('upload_chunk_size', parsed_args.file_upload_chunk_size),
+            ('parallel_chunks', parsed_args.parallel_chunks)]
+        if value is not None}
     # Begin backing up the file, with the options picked by the user
-    google_drive_chunk_error: str = "Error. Google Drive Chunk size must be an integer."
-    file_upload_chunk_error: str = "Error. File Upload Chunk size must be an integer."
-    # Both optional arguments were passed
-    if parsed_args.google_drive_chunk_size and \
-            parsed_args.file_upload_chunk_size:
-        # Try and convert the optional arguments to integers
-        google_drive_chunk_size: int = parse_integer_argument(
-            parsed_args.google_drive_chunk_size, google_drive_chunk_error)
-        file_upload_chunk_size: int = parse_integer_argument(
-            parsed_args.file_upload_chunk_size, file_upload_chunk_error)
-        # None check on integer conversion
-        if google_drive_chunk_size is None or \
-                file_upload_chunk_size is None:
-            return
-        begin_backup(
-            service, parsed_args.file_to_backup, parsed_args.dest_folder_name,
-            google_drive_chunk_size, file_upload_chunk_size)
-    # Only the dest_file_chunk size was passed
-    elif parsed_args.google_drive_chunk_size:
-        # Try and convert the optional argument to an integer
-        google_drive_chunk_size: int = parse_integer_argument(
-            parsed_args.google_drive_chunk_size, google_drive_chunk_error)
-        # None check on integer conversion
-        if google_drive_chunk_size is None:
-            return
-        begin_backup(
-            service, parsed_args.file_to_backup, parsed_args.dest_folder_name,
-            file_chunk_size=google_drive_chunk_size)
-    # Only file upload chunk size was passed
-    elif parsed_args.file_upload_chunk_size:
-        # Try and convert the optional argument to an integer
-        file_upload_chunk_size: int = parse_integer_argument(
-            parsed_args.file_upload_chunk_size, file_upload_chunk_error)
-        # None check on integer conversion
-        if file_upload_chunk_size is None:
-            return
-        begin_backup(
-            service, parsed_args.file_to_backup, parsed_args.dest_folder_name,
-            upload_chunk_size=file_upload_chunk_size)
-    # No optional arguments were passed
-    else:
-        begin_backup(
-            service, parsed_args.file_to_backup, parsed_args.dest_folder_name)
+    begin_backup(service, parsed_args.file_to_backup,
+                 parsed_args.dest_folder_name, **backup_kwargs)
 
 
 if __name__ == '__main__':
@@ -1,14 +1,16 @@
 # STL resources
 import os
+import threading
 import time
 from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor
 
 # Google API libraries
 from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseDownload
 
 # ECBU Modules
-from CommandLineParse import parse_integer_argument
+from CommandLineParse import integer_argument
 from Credentials import get_drive_service
 from DriveAccess import ChangedFile, DriveChunks, find_or_create_backup_folder
 from ErrorWaiting import IncreasingBackoff
@@ -79,8 +81,42 @@ def continuous_chunk_dl_retry(service, local_file, bytes_downloaded: int,
         backoff.wait()
 
 
+def _download_chunks_in_parallel(local_file_name: str,
+                                 pending_downloads: list,
+                                 download_chunk_size: int,
+                                 parallel_chunks: int):
+    """
+    Download the (offset, chunk) pairs in pending_downloads across a
+    bounded pool of worker threads. Each worker opens its own
+    descriptor on the local file and builds its own drive service,
+    because neither the shared file offset nor googleapiclient's
+    service object is safe to share between threads; writes land at
+    disjoint offsets so the workers never overlap.
+    """
+    worker_state = threading.local()
+
+    def download_one(bytes_downloaded: int, chunk: dict):
+        # Build (or re-use) this worker's own drive service
+        service = getattr(worker_state, 'service', None)
+        if service is None:
+            service = worker_state.service = get_drive_service()
+        # Write through a descriptor owned by this worker alone
+        with open(local_file_name, 'rb+') as worker_file:
+            continuous_chunk_dl_retry(service, worker_file,
+                                      bytes_downloaded, download_chunk_size,
+                                      chunk)
+
+    with ThreadPoolExecutor(max_workers=parallel_chunks) as pool:
+        futures: list = [
+            pool.submit(download_one, bytes_downloaded, chunk)
+            for bytes_downloaded, chunk in pending_downloads]
+        for future in futures:
+            future.result()
+
+
 def begin_file_restore(service, backup_folder_name: str, local_file_name: str,
-                       download_chunk_size: int = 1) -> bool:
+                       download_chunk_size: int = 1,
+                       parallel_chunks: int = 1) -> bool:
     """
     Get the ids, names, and sizes of each of the chunks representing the local_file
     within the folder with backup_folder_name on google drive
@@ -109,6 +145,15 @@ def begin_file_restore(service, backup_folder_name: str, local_file_name: str,
         # Find out how big the local file is
         file_stats: os.stat_result = os.fstat(local_file.fileno())
         file_size: int = file_stats.st_size
+        # Reserve the full restored size up front so concurrent chunk
+        # writes land in already-allocated, hopefully contiguous blocks
+        total_size: int = sum(int(chunk['size'])
+                              for chunk in chunk_information)
+        if hasattr(os, 'posix_fallocate') and file_size < total_size:
+            os.posix_fallocate(local_file.fileno(), 0, total_size)
+        # Chunks that need downloading, held back to run across worker
+        # threads after the check pass when the user asked for that
+        pending_downloads: list = list()
         # Go through each chunk, tallying how many bytes we already have
         # as we go.
         bytes_downloaded: int = 0
@@ -130,9 +175,12 @@ def begin_file_restore(service, backup_folder_name: str, local_file_name: str,
                     chunk_representation, chunk['name'])
                 # The chunk has been changed and needs to be re-downloaded in this spot.
                 if result.changed and result.file_id:
-                    continuous_chunk_dl_retry(service, local_file,
-                                              bytes_downloaded, download_chunk_size,
-                                              chunk)
+                    if parallel_chunks > 1:
+                        pending_downloads.append((bytes_downloaded, chunk))
+                    else:
+                        continuous_chunk_dl_retry(service, local_file,
+                                                  bytes_downloaded, download_chunk_size,
+                                                  chunk)
                 # The chunk somehow doesn't exist. Fatal error. Exit.
                 elif result.changed and not result.file_id:
                     print("Error. Chunk: {} somehow doesn't exist in backup.".format(
@@ -144,12 +192,21 @@ def begin_file_restore(service, backup_folder_name: str, local_file_name: str,
                         chunk['name']))
             # We don't have this chunk yet in our local copy.
             else:
-                continuous_chunk_dl_retry(service, local_file,
-                                          bytes_downloaded, download_chunk_size,
-                                          chunk)
+                if parallel_chunks > 1:
+                    pending_downloads.append((bytes_downloaded, chunk))
+                else:
+                    continuous_chunk_dl_retry(service, local_file,
+                                              bytes_downloaded, download_chunk_size,
+                                              chunk)
             # Increment loop counters
             bytes_downloaded += chunk_size
             chunk_num += 1
+        # Pull down everything that needs downloading across worker
+        # threads; each chunk writes to its own disjoint offset
+        if pending_downloads:
+            _download_chunks_in_parallel(local_file_name, pending_downloads,
+                                         download_chunk_size,
+                                         parallel_chunks)
     print("Restore of: {} from {} was successful.".format(
         local_file_name, backup_folder_name))
     return True
@@ -172,8 +229,13 @@ def main():
                           help="The name of the file the backup "
                           "is to be restored to locally.")
     arg_parser.add_argument('--download-chunk-size', dest="download_chunk_size",
+                            type=integer_argument,
                             help="The chunk size for downloading chunks. "
                             "(how many pieces to download each chunk in) (Mebibytes)")
+    arg_parser.add_argument('--parallel-chunks', dest="parallel_chunks",
+                            type=integer_argument,
+                            help="How many chunks to download from google "
+                            "drive at the same time.")
     # Parse the arguments entered by the user
     parsed_args: Namespace = arg_parser.parse_args()
     # Make sure all the required arguments are there
@@ -183,20 +245,16 @@ def main():
         return
     # Build the google drive service
     service = get_drive_service()
-    # Check if the optional argument was passed and
-    # begin pulling down the chunks from google drive
-    if parsed_args.download_chunk_size:
-        # Try and convert the optional arg to an int
-        download_chunk_size: int = parse_integer_argument(parsed_args.download_chunk_size,
-                                                          "Error. Download chunk size "
-                                                          "must be an integer.")
-        if download_chunk_size is None:
-            return
-        begin_file_restore(service, parsed_args.backup_folder_name,
-                           parsed_args.local_file_name, download_chunk_size)
-    else:
-        begin_file_restore(service, parsed_args.backup_folder_name,
-                           parsed_args.local_file_name)
+    # Collect whichever optional arguments were passed (argparse has
+    # already validated them) and begin pulling down the chunks from
+    # google drive
+    restore_kwargs: dict = {
+        keyword: value for keyword, value in [
+            ('download_chunk_size', parsed_args.download_chunk_size),
+            ('parallel_chunks', parsed_args.parallel_chunks)]
+        if value is not None}
+    begin_file_restore(service, parsed_args.backup_folder_name,
+                       parsed_args.local_file_name, **restore_kwargs)
 
 
 if __name__ == "__main__":
@@ -1,3 +1,4 @@
+import random
 import time
 
 
@@ -8,6 +9,10 @@ class IncreasingBackoff:
     max_wait_time is reached. Time values passed are in seconds
     """
 
+    # Fixed attribute layout; skips the per-instance __dict__
+    __slots__ = ('_initial_wait_time', 'wait_time', '_max_wait_time',
+                 '_stepping_multiplier', '_last_wait_ended')
+
     def __init__(self, initial_time_secs: float, max_wait_time: float,
                  stepping_multiplier: int):
         # Set initial values
@@ -15,20 +20,52 @@ class IncreasingBackoff:
         self.wait_time: float = initial_time_secs
         self._max_wait_time: float = max_wait_time
         self._stepping_multiplier: int = stepping_multiplier
+        # When the previous wait (or reset) happened, so time the
+        # failing operation itself burned counts toward the backoff
+        self._last_wait_ended: float = time.monotonic()
 
     def wait(self):
-        # Sleep for the stored amount of time
-        time.sleep(self.wait_time)
-        # Increase the wait time
-        if self.wait_time < self._max_wait_time:
-            wait_time_increase: float = self.wait_time * self._stepping_multiplier
-            # Only multiply if the wait time increase will not
-            # exceed the max wait time.
-            if wait_time_increase > self._max_wait_time:
-                self.wait_time = self._max_wait_time
-                return
-            self.wait_time = wait_time_increase
+        # Pick a random duration up to the stored amount of time
+        # ("full jitter"), so that parallel workers retrying after the
+        # same failure don't all wake up and hit the server in lockstep
+        sleep_for: float = random.uniform(0, self.wait_time)
+        # Credit whatever wall-clock time the failed attempt already
+        # took (e.g. a slow timeout) against this wait, instead of
+        # stacking a full backoff on top of the attempt's own delay
+        elapsed: float = time.monotonic() - self._last_wait_ended
+        sleep_for = max(0.0, sleep_for - elapsed)
+        if sleep_for > 0:
+            time.sleep(sleep_for)
+        # Increase the wait time, clamped to the configured maximum
+        self.wait_time = min(self.wait_time * self._stepping_multiplier,
+                             self._max_wait_time)
+        self._last_wait_ended = time.monotonic()
 
     def reset_to_initial(self):
         # Reset the increasing backoff back to the start again
         self.wait_time = self._initial_wait_time
+        self._last_wait_ended = time.monotonic()
+
+
+class RequestRateLimiter:
+
+    """
+    Keeps the rate that requests are issued at or below
+    requests_per_second, only sleeping when requests come in faster
+    than the budget allows (rather than a fixed sleep per request).
+    """
+
+    __slots__ = ('_min_interval', '_next_allowed')
+
+    def __init__(self, requests_per_second: float):
+        self._min_interval: float = 1.0 / requests_per_second
+        self._next_allowed: float = 0.0
+
+    def wait_for_turn(self):
+        # Sleep off whatever is left of the interval since the
+        # previous request, if anything
+        now: float = time.monotonic()
+        if now < self._next_allowed:
+            time.sleep(self._next_allowed - now)
+            now = time.monotonic()
+        self._next_allowed = now + self._min_interval
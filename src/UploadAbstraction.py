@@ -1,10 +1,41 @@
 # STL resources
+import mmap
 import os
 from io import BufferedReader
+from threading import Lock
 
 # Google API libraries
 from googleapiclient.http import MediaUpload
 
+# One read-only mapping per underlying file (keyed by device and inode),
+# shared by every chunk of that file so address space isn't re-mapped
+# per chunk. Mappings live for the rest of the process.
+_mmap_cache: dict = dict()
+_mmap_cache_lock: Lock = Lock()
+
+
+def _shared_mmap(file_descriptor):
+    """
+    Return the shared read-only mmap for the file behind
+    file_descriptor, creating it on first use. Returns None when the
+    descriptor can't be memory mapped (not a real file, or empty).
+    """
+    try:
+        fileno: int = file_descriptor.fileno()
+        stats: os.stat_result = os.fstat(fileno)
+    except (AttributeError, OSError):
+        return None
+    key: tuple = (stats.st_dev, stats.st_ino)
+    with _mmap_cache_lock:
+        mapping = _mmap_cache.get(key)
+        if mapping is None:
+            try:
+                mapping = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                return None
+            _mmap_cache[key] = mapping
+    return mapping
+
 
 class InvalidChunkException(ValueError):
     pass
@@ -29,17 +60,24 @@ class ECBUMediaUpload(MediaUpload):
         google drive. We want this.
     """
 
+    # Same for every chunk, so keep it on the class rather than
+    # assigning it per instance
+    _mimetype = "application/octet-stream"
+
     def __init__(self, file_descriptor: BufferedReader, file_size: int, begin_index: int,
-                 end_index: int, chunk_size: int = 1 * (1024 * 1024), resumable: bool = True):
+                 end_index: int, chunk_size: int = 8 * (1024 * 1024), resumable: bool = True):
         self._file_descriptor = file_descriptor
-        self._mimetype = "application/octet-stream"
-        # check if we are within the bounds of the file
-        if begin_index > file_size or end_index > file_size \
-                or begin_index < 0 or end_index < 0:
+        # check if we are within the bounds of the file; the chained
+        # comparison also rejects segments whose begin is past their
+        # end, which would otherwise yield a negative size()
+        if not 0 <= begin_index <= end_index <= file_size:
             raise OffsetOutOfBoundsException(
                 'One of the offsets provided is outside the length of the file.')
         self._begin_index = begin_index
         self._end_index = end_index
+        # Hoisted out of getbytes/readinto so the per-call clamp is a
+        # single subtraction against a stored value
+        self._segment_length = end_index - begin_index
         # Make sure that the chunk size makes sense
         if chunk_size < 0:
             raise InvalidChunkException(
@@ -47,14 +85,46 @@ class ECBUMediaUpload(MediaUpload):
         self._chunk_size = chunk_size
         self._resumable = resumable
 
+    def identity(self) -> tuple or None:
+        """
+        Identity tuple (file name, modification time, begin and end
+        indices) for the bytes backing this upload, usable as a
+        memoization key for the chunk's hash. Returns None when the
+        descriptor isn't backed by a real file.
+        """
+        try:
+            file_stats: os.stat_result = os.fstat(
+                self._file_descriptor.fileno())
+        except (AttributeError, OSError):
+            return None
+        # Descriptors from os.fdopen report the integer fd as their
+        # name; without a real path there is nothing stable to key a
+        # persisted digest on
+        name = getattr(self._file_descriptor, 'name', None)
+        if not isinstance(name, str):
+            return None
+        return (name, file_stats.st_mtime_ns,
+                self._begin_index, self._end_index)
+
     def chunksize(self) -> int:
         return self._chunk_size
 
+    def set_chunksize(self, chunk_size: int):
+        """
+        Adjust how many bytes are handed to the drive service per
+        resumable request. The service re-reads chunksize() before each
+        piece, so growing it mid-upload takes effect on the next one.
+        """
+        if chunk_size < 0:
+            raise InvalidChunkException(
+                'The chunk size must be greater than zero.')
+        self._chunk_size = chunk_size
+
     def mimetype(self) -> str:
         return self._mimetype
 
     def size(self) -> int:
-        return (self._end_index - self._begin_index)
+        return self._segment_length
 
     def resumable(self) -> bool:
         return self._resumable
@@ -67,14 +137,78 @@ class ECBUMediaUpload(MediaUpload):
         Unless it goes off the end. Then shorten the length
         to only go to to end_index
         """
+        # The client library probes past the end of the final chunk;
+        # answer that without touching the descriptor at all
+        if begin >= self._segment_length:
+            return b''
         read_start_index: int = begin + self._begin_index
-        self._file_descriptor.seek(read_start_index)
         # Make sure we don't go out of bounds of our
         # segment of the file
-        if (read_start_index + length) > self._end_index:
-            length = (self._end_index - read_start_index)
+        length = min(length, self._segment_length - begin)
+        # Serve the bytes straight out of the shared mapping when there
+        # is one: the page cache hands them over without a seek or read
+        # syscall, and the descriptor's offset is left alone so other
+        # threads reading through it aren't disturbed
+        mapping = _shared_mmap(self._file_descriptor)
+        if mapping is not None and len(mapping) >= self._end_index:
+            return mapping[read_start_index:read_start_index + length]
+        # pread takes the offset with the read itself, so concurrent
+        # readers of the shared descriptor never race on its position
+        if hasattr(os, 'pread'):
+            try:
+                return os.pread(self._file_descriptor.fileno(), length,
+                                read_start_index)
+            except (AttributeError, OSError):
+                pass
+        # Sequential getbytes calls leave the descriptor exactly where
+        # the next read starts; only seek (which flushes the reader's
+        # buffer) when it is actually somewhere else. tell() is served
+        # from the buffered position, not a syscall.
+        if self._file_descriptor.tell() != read_start_index:
+            self._file_descriptor.seek(read_start_index)
         return self._file_descriptor.read(length)
 
+    def getbuffer(self) -> memoryview or None:
+        """
+        A zero-copy view over this chunk's bytes, backed by the shared
+        read-only mmap of the whole file. Reading through it never
+        touches the descriptor's seek offset, so it is safe to use from
+        several threads at once. Returns None when the file can't be
+        mapped or doesn't cover this chunk.
+        """
+        mapping = _shared_mmap(self._file_descriptor)
+        if mapping is None or len(mapping) < self._end_index:
+            return None
+        return memoryview(mapping)[self._begin_index:self._end_index]
+
+    def readinto(self, buffer, offset: int) -> int:
+        """
+        Read bytes of this chunk starting at offset (relative to the
+        chunk) directly into the passed writable buffer, returning the
+        number of bytes read. Skips the intermediate bytes object that
+        getbytes has to allocate.
+        """
+        read_start_index: int = offset + self._begin_index
+        # Make sure we don't go out of bounds of our
+        # segment of the file
+        length: int = min(len(buffer), self._segment_length - offset)
+        if length <= 0:
+            return 0
+        # Position-independent scatter read straight into the caller's
+        # buffer; no seek, so safe alongside other readers
+        if hasattr(os, 'preadv'):
+            try:
+                return os.preadv(self._file_descriptor.fileno(),
+                                 [memoryview(buffer)[:length]],
+                                 read_start_index)
+            except (AttributeError, OSError):
+                pass
+        # As in getbytes: only pay for the seek when the descriptor
+        # isn't already sitting at the read position
+        if self._file_descriptor.tell() != read_start_index:
+            self._file_descriptor.seek(read_start_index)
+        return self._file_descriptor.readinto(memoryview(buffer)[:length])
+
     def has_stream(self) -> bool:
         # We don't want it to use this interface. We want it to
         # use getbytes